@@ -1,19 +1,30 @@
+import io
 import os
 import sys
 import time
+import queue
+import threading
+import multiprocessing
 import concurrent.futures
 from pathlib import Path
 from tqdm import tqdm
-from PIL import Image
+import PIL
+from PIL import Image, features
 from pillow_heif import register_heif_opener
-from wand.image import Image as WandImage
+import rawpy
 
 register_heif_opener()
+# Workers via 'spawn': o rawpy (com OpenMP) pode travar em processos criados com fork
+MP_CONTEXT = multiprocessing.get_context('spawn')
 
 def convert_heic_to_png(input_path, output_path):
     try:
         with Image.open(input_path) as img:
-            img.save(output_path, 'PNG', optimize=True)
+            if img.mode != 'RGB':
+                rgb = img.convert('RGB')
+                img.close()
+                img = rgb
+            img.save(output_path, 'PNG', compress_level=1)
         return True
     except Exception as e:
         print(f"Erro ao converter {input_path}: {str(e)}")
@@ -21,116 +32,257 @@ def convert_heic_to_png(input_path, output_path):
 
 def convert_cr2_to_png(input_path, output_path):
     try:
-        with WandImage(filename=input_path) as img:
-            img.format = 'png'
-            img.compression_quality = 90
-            if img.alpha_channel:
-                img.alpha_channel = 'remove'
-            img.save(filename=output_path)
+        with rawpy.imread(input_path) as raw:
+            rgb = raw.postprocess(use_camera_wb=True, no_auto_bright=True, output_bps=8)
+        Image.fromarray(rgb).save(output_path, 'PNG', compress_level=1)
         return True
     except Exception as e:
         print(f"Erro ao converter {input_path}: {str(e)}")
         return False
 
-def optimize_png(input_path, output_path, max_size_mb=15):
+def open_source(input_path, data, max_dimension):
+    # CR2 passa pelo libraw; HEIC/HEIF pelo Pillow (opener do pillow-heif)
+    if input_path.lower().endswith('.cr2'):
+        with rawpy.imread(io.BytesIO(data)) as raw:
+            # Meia resolução quando ela ainda cobre o alvo: evita demosaico
+            # de pixels que o thumbnail() descartaria
+            half_size = max(raw.sizes.width, raw.sizes.height) // 2 >= max_dimension
+            rgb = raw.postprocess(use_camera_wb=True, no_auto_bright=True, output_bps=8, half_size=half_size)
+        return Image.fromarray(rgb)
+    return Image.open(io.BytesIO(data))
+
+def encode_jpeg(input_path, data, max_size_mb=15, optimize=True):
     try:
-        with Image.open(input_path) as img:
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            max_dimension = 4000
-            w, h = img.size
-            if w > max_dimension or h > max_dimension:
-                if w > h:
-                    new_w = max_dimension
-                    new_h = int(h * (max_dimension / w))
-                else:
-                    new_h = max_dimension
-                    new_w = int(w * (max_dimension / h))
-                img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+        max_dimension = 4000
+        with open_source(input_path, data, max_dimension) as img:
+            # Decodifica já em RGB (3 bytes/pixel) e libera alfa/paleta
+            img.load()
+            if img.mode != 'RGB':
+                # Fecha o original para não manter os dois buffers no resize
+                rgb = img.convert('RGB')
+                img.close()
+                img = rgb
+            # reducing_gap: reduce() inteiro barato até ~3x o alvo, depois Lanczos
+            img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS, reducing_gap=3.0)
             
-            quality = 90
-            while True:
-                img.save(output_path, 'JPEG', quality=quality, optimize=True)
-                size_mb = os.path.getsize(output_path) / (1024 * 1024)
-                if size_mb <= max_size_mb or quality < 30:
-                    return True, size_mb
-                quality -= 5
+            # Codifica uma vez em memória com Huffman padrão (mais rápido); se
+            # passar do limite, estima a qualidade pela curva de taxa
+            # (~proporcional entre 50 e 90) e recodifica com optimize, que só
+            # reduz o arquivo
+            quality = 85
+            buf = io.BytesIO()
+            img.save(buf, 'JPEG', quality=quality, optimize=False)
+            size_mb = buf.tell() / (1024 * 1024)
+            # No máximo duas recodificações, com piso de qualidade 25
+            for _ in range(2):
+                if size_mb <= max_size_mb or quality <= 25:
+                    break
+                quality = max(25, min(quality - 5, int(quality * (max(max_size_mb, 0) / size_mb) ** 0.9)))
+                buf = io.BytesIO()
+                img.save(buf, 'JPEG', quality=quality, optimize=optimize)
+                size_mb = buf.tell() / (1024 * 1024)
+            if size_mb > max_size_mb:
+                print(f"Aviso: {input_path} ficou com {size_mb:.2f} MB (limite {max_size_mb} MB) na qualidade {quality}")
+            return buf.getvalue()
     except Exception as e:
         print(f"Erro ao otimizar {input_path}: {str(e)}")
-        return False, 0
+        return None
 
-def get_files_for_conversion(input_dir, ctype):
-    exts = ['.heic', '.HEIC', '.heif', '.HEIF'] if ctype == 'HEIC' else ['.cr2', '.CR2']
+def read_sources(task_q, read_q, stop):
+    while not stop.is_set():
+        task = task_q.get()
+        if task is None:
+            return
+        i, o = task
+        try:
+            data = Path(i).read_bytes()
+        except Exception as e:
+            print(f"Erro ao ler {i}: {str(e)}")
+            data = None
+        # put com timeout para não travar se o consumidor parar (erro/Ctrl+C)
+        while not stop.is_set():
+            try:
+                read_q.put((i, o, data), timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+def write_results(write_q, stats, sizes, pbar):
+    while True:
+        item = write_q.get()
+        if item is None:
+            return
+        i, o, data = item
+        if data is not None:
+            try:
+                Path(o).write_bytes(data)
+                stats['success'] += 1
+                stats['original'] += sizes[i] / (1024 * 1024)
+                stats['size'] += len(data) / (1024 * 1024)
+            except Exception as e:
+                print(f"Erro ao salvar {o}: {str(e)}")
+                stats['fail'] += 1
+        else:
+            stats['fail'] += 1
+        pbar.update(1)
+
+def check_pillow_build():
+    # Pillow-SIMD publica versões com sufixo ".postN" (ex.: 11.1.0.post1)
+    simd = '.post' in PIL.__version__
+    turbo = features.check_feature('libjpeg_turbo')
+    print(f"Pillow {PIL.__version__} (SIMD: {'sim' if simd else 'não'}, "
+          f"libjpeg-turbo: {'sim' if turbo else 'não'})")
+
+def find_files(input_dir, exts):
+    # Percorre a árvore uma única vez e guarda o tamanho vindo do DirEntry
     files = []
-    for ext in exts:
-        files.extend(list(Path(input_dir).glob(f'**/*{ext}')))
+    stack = [input_dir]
+    while stack:
+        # Pastas sem permissão são ignoradas, como no glob/os.walk
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(exts):
+                    # Link quebrado ou sem acesso: entra com tamanho 0 e falha
+                    # na leitura, como um arquivo qualquer
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        size = 0
+                    files.append((entry.path, size))
     return files
 
-def process_conversion(files, input_dir, output_dir, func, max_workers):
+def get_files_for_conversion(input_dir, ctype):
+    exts = ('.heic', '.heif') if ctype == 'HEIC' else ('.cr2',)
+    return find_files(input_dir, exts)
+
+def build_tasks(files, input_dir, output_dir, suffix):
+    # Monta os caminhos com operações de string e cria cada pasta uma só vez
+    input_prefix = os.path.join(input_dir, '')
+    output_prefix = os.path.join(output_dir, '')
+    seen_dirs = set()
     tasks = []
-    for f in files:
-        rel = f.relative_to(input_dir)
-        out = Path(output_dir) / rel.with_suffix('.png')
-        out.parent.mkdir(parents=True, exist_ok=True)
-        tasks.append((str(f), str(out)))
+    # Maiores primeiro (LPT): evita que um arquivo grande fique para o final
+    for f, _ in sorted(files, key=lambda t: t[1], reverse=True):
+        out = output_prefix + os.path.splitext(f[len(input_prefix):])[0] + suffix
+        parent = os.path.dirname(out)
+        if parent not in seen_dirs:
+            os.makedirs(parent, exist_ok=True)
+            seen_dirs.add(parent)
+        tasks.append((f, out))
+    return tasks
+
+def convert_batch(func, tasks):
+    return [func(i, o) for i, o in tasks]
+
+def process_conversion(files, input_dir, output_dir, func, max_workers):
+    tasks = build_tasks(files, input_dir, output_dir, '.png')
     
     start = time.time()
     success, fail = 0, 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(func, i, o): (i, o) for i, o in tasks}
-        with tqdm(total=len(tasks), desc="Convertendo imagens", unit="img") as pbar:
-            for future in concurrent.futures.as_completed(futures):
-                if future.result():
-                    success += 1
-                else:
-                    fail += 1
-                elapsed = time.time() - start
-                pbar.set_postfix_str(f"Sucesso: {success}, Falhas: {fail}, Tempo: {elapsed:.2f}s")
-                pbar.update(1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=MP_CONTEXT, initializer=register_heif_opener) as ex:
+        # map em lotes (uma ida e volta de IPC por lote). Os lotes são
+        # intercalados (tasks[k::n]) para não juntar os maiores arquivos da
+        # ordenação LPT num mesmo worker
+        n_chunks = min(len(tasks), max_workers * 4)
+        chunks = [tasks[k::n_chunks] for k in range(n_chunks)]
+        results = ex.map(convert_batch, [func] * n_chunks, chunks)
+        # Atualiza a barra em lotes para reduzir escritas no terminal
+        postfix = "Sucesso: {}, Falhas: {}, Tempo: {:.2f}s"
+        with tqdm(total=len(tasks), desc="Convertendo imagens", unit="img",
+                  mininterval=0.2, miniters=max(1, len(tasks) // 500)) as pbar:
+            n = 0
+            for batch in results:
+                for ok in batch:
+                    n += 1
+                    if ok:
+                        success += 1
+                    else:
+                        fail += 1
+                    if n % 64 == 0 or n == len(tasks):
+                        pbar.set_postfix_str(postfix.format(success, fail, time.time() - start), refresh=False)
+                    pbar.update(1)
     print("\nConversão concluída!")
     print(f"Convertidas com sucesso: {success}")
     print(f"Falhas: {fail}")
 
-def process_optimization(input_dir, output_dir, max_workers, max_size_mb):
-    png_files = list(Path(input_dir).glob('**/*.png'))
-    if not png_files:
-        print("Nenhum arquivo PNG encontrado para otimização.")
-        return
-    print(f"\nEncontrados {len(png_files)} arquivos PNG para otimização.")
-    tasks = []
-    total_original_size = 0
-    for p in png_files:
-        rel = p.relative_to(input_dir)
-        out = Path(output_dir) / rel.with_suffix('.jpg')
-        out.parent.mkdir(parents=True, exist_ok=True)
-        tasks.append((str(p), str(out)))
-        total_original_size += os.path.getsize(p) / (1024 * 1024)
+def process_optimization(files, input_dir, output_dir, max_workers, max_size_mb):
+    tasks = build_tasks(files, input_dir, output_dir, '.jpg')
+    sizes = dict(files)
     
+    # Pipeline: threads de leitura -> processos de codificação -> thread de
+    # escrita, com filas limitadas para não acumular imagens em memória
+    readers = 4
+    queue_size = max_workers * 2
+    task_q = queue.Queue()
+    read_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+    for t in tasks:
+        task_q.put(t)
+    for _ in range(readers):
+        task_q.put(None)
+
     start = time.time()
-    success, fail = 0, 0
-    total_optimized_size = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(optimize_png, i, o, max_size_mb): (i, o) for i, o in tasks}
-        with tqdm(total=len(tasks), desc="Otimizando imagens", unit="img") as pbar:
-            for future in concurrent.futures.as_completed(futures):
-                ok, size_mb = future.result()
-                if ok:
-                    success += 1
-                    total_optimized_size += size_mb
-                else:
-                    fail += 1
-                pbar.update(1)
+    stats = {'success': 0, 'fail': 0, 'original': 0, 'size': 0}
+    with tqdm(total=len(tasks), desc="Otimizando imagens", unit="img",
+              mininterval=0.2, miniters=max(1, len(tasks) // 500)) as pbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=readers) as io_ex, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=MP_CONTEXT, initializer=register_heif_opener) as ex:
+        stop = threading.Event()
+        for _ in range(readers):
+            io_ex.submit(read_sources, task_q, read_q, stop)
+        writer = threading.Thread(target=write_results, args=(write_q, stats, sizes, pbar), daemon=True)
+        writer.start()
+
+        pending = {}
+        try:
+            for _ in range(len(tasks)):
+                i, o, data = read_q.get()
+                if data is None:
+                    write_q.put((i, o, None))
+                    continue
+                pending[ex.submit(encode_jpeg, i, data, max_size_mb)] = (i, o)
+                if len(pending) >= queue_size:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        write_q.put((*pending.pop(future), future.result()))
+            for future in concurrent.futures.as_completed(pending):
+                write_q.put((*pending[future], future.result()))
+        finally:
+            # Em caso de erro (worker morto, Ctrl+C) libera leitores e escritor
+            # para que o encerramento dos pools não fique bloqueado
+            stop.set()
+            for future in pending:
+                future.cancel()
+            while True:
+                try:
+                    read_q.get_nowait()
+                except queue.Empty:
+                    break
+            write_q.put(None)
+            writer.join()
+    success, fail = stats['success'], stats['fail']
+    total_original_size = stats['original']
+    total_optimized_size = stats['size']
     elapsed = time.time() - start
     print("\nOtimização concluída!")
     print(f"Convertidas com sucesso: {success}")
     print(f"Falhas: {fail}")
-    print(f"Tamanho original: {total_original_size:.2f} MB")
-    print(f"Tamanho otimizado: {total_optimized_size:.2f} MB")
+    # Compara apenas os arquivos gravados: origem (HEIC/CR2) x JPEG gerado
+    print(f"Tamanho de origem (arquivos convertidos): {total_original_size:.2f} MB")
+    print(f"Tamanho JPEG: {total_optimized_size:.2f} MB")
     if total_original_size > 0:
-        print(f"Redução: {((total_original_size - total_optimized_size) / total_original_size * 100):.2f}%")
+        print(f"Redução em relação à origem: {((total_original_size - total_optimized_size) / total_original_size * 100):.2f}%")
     print(f"Tempo otimização: {elapsed:.2f}s")
 
 if __name__ == "__main__":
+    check_pillow_build()
+
     # Tipo
     while True:
         ctype = input("Digite o tipo de conversão (HEIC ou CR2): ")
@@ -146,12 +298,29 @@ if __name__ == "__main__":
             break
         print("Caminho inválido.")
     
-    # Destino conversão
-    while True:
-        output_dir = input("Caminho de destino para conversão: ")
-        if Path(output_dir).parent.exists():
-            break
-        print("Caminho inválido.")
+    # Otimização: gera o JPEG direto da origem, sem PNG intermediário
+    optimize_choice = input("Deseja gerar JPEG otimizado direto da origem? (S/N, N = converter para PNG): ").upper()
+    if optimize_choice == 'S':
+        while True:
+            output_dir = input("Caminho de destino para otimização (JPEG): ")
+            if Path(output_dir).parent.exists():
+                break
+            print("Caminho inválido.")
+
+        max_mb = 15
+        try:
+            val = input("Tamanho máximo em MB (padrão 15): ")
+            if val.strip() and int(val) > 0:
+                max_mb = int(val)
+        except:
+            pass
+    else:
+        # Destino conversão
+        while True:
+            output_dir = input("Caminho de destino para conversão: ")
+            if Path(output_dir).parent.exists():
+                break
+            print("Caminho inválido.")
     
     files = get_files_for_conversion(input_dir, ctype)
     if not files:
@@ -172,6 +341,17 @@ if __name__ == "__main__":
         except ValueError:
             print(f"Opção inválida. Escolha entre {thread_options}.")
 
+    # A conversão para PNG usa 2x processos para esconder a leitura dos
+    # arquivos (ela não tem leitores antecipados); cada processo guarda uma
+    # imagem decodificada inteira, então isso dobra o pico de memória. A
+    # otimização já antecipa a leitura e usa o valor escolhido
+    conv_workers = chosen_threads * 2
+    opt_workers = chosen_threads
+    # No Windows o ProcessPoolExecutor aceita no máximo 61 workers
+    if sys.platform == 'win32':
+        conv_workers = min(conv_workers, 61)
+        opt_workers = min(opt_workers, 61)
+
     avg_time = 0.5
     estimated = (len(files) * avg_time) / chosen_threads
     print(f"\nEstimativa de tempo de conversão: ~{estimated:.2f}s (pode variar)")
@@ -179,40 +359,23 @@ if __name__ == "__main__":
     print("\nConfirmação:")
     print(f"Tipo: {ctype}")
     print(f"Origem: {input_dir}")
-    print(f"Destino conversão: {output_dir}")
-    print(f"Threads: {chosen_threads}")
+    if optimize_choice == 'S':
+        print(f"Destino otimização (JPEG, máx. {max_mb} MB): {output_dir}")
+    else:
+        print(f"Destino conversão: {output_dir}")
+    print(f"Threads: {chosen_threads} (conversão: {conv_workers}, otimização: {opt_workers})")
     confirm = input("Prosseguir? (S/N): ").upper()
     if confirm != 'S':
         print("Conversão cancelada.")
         sys.exit()
 
     start_total = time.time()
-    func = convert_heic_to_png if ctype == 'HEIC' else convert_cr2_to_png
-    process_conversion(files, input_dir, output_dir, func, chosen_threads)
-    conv_time = time.time() - start_total
-
-    # Pergunta otimização
-    optimize_choice = input("\nDeseja otimizar as imagens convertidas? (S/N): ").upper()
     if optimize_choice == 'S':
-        while True:
-            output_dir_opt = input("Caminho de destino para otimização (JPEG): ")
-            if Path(output_dir_opt).parent.exists():
-                break
-            print("Caminho inválido.")
-        
-        max_mb = 15
-        try:
-            val = input("Tamanho máximo em MB (padrão 15): ")
-            if val.strip():
-                max_mb = int(val)
-        except:
-            pass
-
-        start_opt = time.time()
-        process_optimization(output_dir, output_dir_opt, chosen_threads, max_mb)
-        opt_time = time.time() - start_opt
-
+        process_optimization(files, input_dir, output_dir, opt_workers, max_mb)
         total_time = time.time() - start_total
         print(f"\nTempo total (conversão+otimização): {total_time:.2f}s")
     else:
+        func = convert_heic_to_png if ctype == 'HEIC' else convert_cr2_to_png
+        process_conversion(files, input_dir, output_dir, func, conv_workers)
+        conv_time = time.time() - start_total
         print(f"\nTempo total (apenas conversão): {conv_time:.2f}s")